@@ -0,0 +1,575 @@
+# -*- coding: utf-8 -*-
+"""
+Client library for the Ezekiel socket protocol (see :mod:`bouser_ezekiel.rawsock`).
+
+Two flavours are provided:
+
+* :class:`EzekielClient` for Twisted applications. Methods return Deferreds.
+* :class:`EzekielBlockingClient` for plain threaded code and batch jobs.
+
+Both keep a small pool of persistent authenticated connections, pipeline concurrent
+requests over them and prolong every held tmp lock from a single shared timer before
+the lock expires. Locks acquired through a client are bound to the lifetime of its
+connections: closing the client releases them on the server side.
+"""
+import contextlib
+import socket
+import threading
+import time
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.internet.endpoints import clientFromString, connectProtocol
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+from twisted.python import failure, log
+
+from .service import Lock, LockAlreadyAcquired, LockNotFound
+
+__author__ = 'viruzzz-kun'
+
+
+class EzekielClientError(Exception):
+    pass
+
+
+class EzekielLockLost(EzekielClientError):
+    """
+    The server dropped a lock the client believed to hold: its connection was lost or
+    it could not be prolonged
+    """
+    def __init__(self, lock, reason):
+        self.lock = lock
+        self.reason = reason
+        super(EzekielLockLost, self).__init__(u'Lock for "%s" lost: %s' % (lock.object_id, reason))
+
+
+def parse_response(line):
+    """
+    Parse a single response line of the socket protocol
+    :param line: response line
+    :return: list of response fields after "OK"
+    :raise: LockAlreadyAcquired, LockNotFound, EzekielClientError
+    """
+    parts = line.split(' ')
+    status = parts[0]
+    if status in ('OK', 'PONG'):
+        return parts[1:]
+    if status == 'LOCKED':
+        object_id, acquire_time, locker = parts[1], parts[2], ' '.join(parts[3:])
+        raise LockAlreadyAcquired(Lock(object_id, acquire_time, None, None, locker))
+    if status == 'NOTFOUND':
+        raise LockNotFound(parts[1])
+    raise EzekielClientError(' '.join(parts[1:]) or line)
+
+
+class _ClientBase(object):
+    """
+    Bookkeeping of the held tmp locks shared by both client flavours. Every held lock
+    remembers the connection it was acquired on, since the server releases it when
+    that connection is lost.
+    """
+    def __init__(self, token, prolong_margin, on_lock_lost=None):
+        self.token = token
+        self.prolong_margin = prolong_margin
+        self.on_lock_lost = on_lock_lost
+        self.user_id = None
+        self._held = {}
+        self._watchers = {}
+        self._held_lock = threading.Lock()
+
+    @property
+    def prolong_period(self):
+        return max(1, self.prolong_margin / 2)
+
+    def _make_lock(self, fields):
+        object_id, token, acquire_time, expiration_time, lease = fields
+        return Lock(
+            object_id,
+            acquire_time,
+            None if expiration_time == '-' else int(expiration_time),
+            token.decode('hex'),
+            self.user_id,
+            None if lease == '-' else int(lease),
+        )
+
+    def _hold(self, lock, connection=None):
+        if lock.lease is None:
+            # Not a tmp lock, nothing to prolong
+            return lock
+        with self._held_lock:
+            held = self._held.get(lock.object_id)
+            if connection is None and held is not None:
+                connection = held[2]
+            self._held[lock.object_id] = (lock, time.time() + lock.lease, connection)
+        return lock
+
+    def _forget(self, object_id):
+        with self._held_lock:
+            held = self._held.pop(object_id, None)
+            if held is not None:
+                self._watchers.pop(held[0].token, None)
+
+    def _watch(self, lock, callback):
+        """
+        Call callback(lock, reason) if the lock is lost before it is released
+        """
+        with self._held_lock:
+            self._watchers.setdefault(lock.token, []).append(callback)
+
+    def _lose(self, locks, reason):
+        with self._held_lock:
+            callbacks = []
+            for lock in locks:
+                held = self._held.get(lock.object_id)
+                if held is not None and held[0].token == lock.token:
+                    del self._held[lock.object_id]
+                callbacks.append(self._watchers.pop(lock.token, []))
+        for lock, lock_callbacks in zip(locks, callbacks):
+            log.msg(u'Lock for "%s" lost: %s' % (lock.object_id, reason), system='Ezekiel:Client')
+            for callback in lock_callbacks:
+                callback(lock, reason)
+            if self.on_lock_lost is not None:
+                self.on_lock_lost(lock, reason)
+
+    def _lose_connection(self, connection, reason):
+        with self._held_lock:
+            locks = [lock for lock, deadline, held_on in self._held.values() if held_on is connection]
+        if locks:
+            self._lose(locks, reason)
+
+    def _connection_of(self, lock):
+        with self._held_lock:
+            held = self._held.get(lock.object_id)
+        if held is not None and held[0].token == lock.token:
+            return held[2]
+
+    def _due(self):
+        threshold = time.time() + self.prolong_margin
+        with self._held_lock:
+            return [lock for lock, deadline, connection in self._held.values() if deadline <= threshold]
+
+    def is_held(self, lock):
+        with self._held_lock:
+            held = self._held.get(lock.object_id)
+        return held is not None and held[0].token == lock.token
+
+
+class EzekielClientProtocol(LineReceiver):
+    """
+    Pipelining protocol: requests are written immediately and responses are matched
+    to them in order. Requests issued before the connection is made are buffered.
+    """
+    delimiter = '\n'
+
+    def __init__(self, client):
+        self.client = client
+        self._waiting = deque()
+        self._outgoing = []
+
+    def request(self, line):
+        d = Deferred()
+        self._waiting.append(d)
+        if self._outgoing is None:
+            self.sendLine(line)
+        else:
+            self._outgoing.append(line)
+        return d
+
+    def connectionMade(self):
+        lines, self._outgoing = self._outgoing, None
+        self.transport.write(''.join(line + self.delimiter for line in lines))
+
+    def connectionFailed(self, failure):
+        self.client._discard(self, failure)
+        self._fail_all(failure)
+
+    def connectionLost(self, reason):
+        self.client._discard(self, reason)
+        self._fail_all(reason)
+
+    def lineReceived(self, line):
+        if not self._waiting:
+            log.msg(u'Unexpected response: %s' % line, system='Ezekiel:Client')
+            return
+        d = self._waiting.popleft()
+        try:
+            result = parse_response(line)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+
+    def _fail_all(self, failure):
+        while self._waiting:
+            self._waiting.popleft().errback(failure)
+
+
+class EzekielClient(_ClientBase):
+    """
+    Twisted client
+    :param endpoint: Twisted client endpoint string, e.g. "tcp:host=localhost:port=5051" or "unix:path=/run/ezekiel"
+    :param token: Castiel authentication token (raw bytes)
+    :param pool_size: Number of persistent connections
+    :param prolong_margin: Prolong tmp locks that expire within this many seconds
+    :param on_lock_lost: Called as on_lock_lost(lock, reason) for every tmp lock the server has dropped
+    """
+    def __init__(self, endpoint, token, pool_size=2, prolong_margin=10, reactor=None, on_lock_lost=None):
+        super(EzekielClient, self).__init__(token, prolong_margin, on_lock_lost)
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.endpoint = endpoint
+        self.pool_size = pool_size
+        self._connections = []
+        self._next = 0
+        self._prolong_lc = LoopingCall(self._prolong_due)
+        self._prolong_lc.clock = reactor
+
+    def _connect(self):
+        def _cb_auth(fields):
+            self.user_id = fields[0]
+
+        def _eb_auth(failure):
+            log.msg(u'Authentication failed: %s' % failure.getErrorMessage(), system='Ezekiel:Client')
+
+        protocol = EzekielClientProtocol(self)
+        protocol.request('AUTH %s' % self.token.encode('hex')).addCallbacks(_cb_auth, _eb_auth)
+        connectProtocol(clientFromString(self.reactor, self.endpoint), protocol).addErrback(protocol.connectionFailed)
+        self._connections.append(protocol)
+        return protocol
+
+    def _discard(self, protocol, reason):
+        if protocol in self._connections:
+            self._connections.remove(protocol)
+        self._lose_connection(protocol, reason.getErrorMessage())
+
+    def _get_protocol(self):
+        if len(self._connections) < self.pool_size:
+            return self._connect()
+        self._next = (self._next + 1) % len(self._connections)
+        return self._connections[self._next]
+
+    def _call(self, *parts, **kwargs):
+        protocol = kwargs.get('protocol') or self._get_protocol()
+        return protocol.request(' '.join(parts))
+
+    def _hold(self, lock, connection=None):
+        super(EzekielClient, self)._hold(lock, connection)
+        if lock.lease is not None and not self._prolong_lc.running:
+            self._prolong_lc.start(self.prolong_period, False)
+        return lock
+
+    def _prolong_due(self):
+        def _eb(failure, lock):
+            self._lose([lock], failure.getErrorMessage())
+
+        if not self._held:
+            self._prolong_lc.stop()
+            return
+        for lock in self._due():
+            self.prolong(lock).addErrback(_eb, lock)
+
+    def ping(self):
+        return self._call('PING')
+
+    def acquire(self, object_id):
+        return self._call('ACQUIRE', object_id).addCallback(self._make_lock)
+
+    def acquire_tmp(self, object_id, timeout=None):
+        parts = ('ACQUIRE_TMP', object_id) if timeout is None else ('ACQUIRE_TMP', object_id, str(timeout))
+        protocol = self._get_protocol()
+        return self._call(*parts, protocol=protocol).addCallback(self._make_lock).addCallback(self._hold, protocol)
+
+    def prolong(self, lock):
+        protocol = self._connection_of(lock)
+        return self._call('PROLONG', lock.object_id, lock.token.encode('hex'), protocol=protocol)\
+            .addCallback(self._make_lock).addCallback(self._hold)
+
+    def release(self, lock):
+        protocol = self._connection_of(lock)
+        self._forget(lock.object_id)
+        return self._call('RELEASE', lock.object_id, lock.token.encode('hex'), protocol=protocol)
+
+    def locked(self, object_id, func, timeout=None):
+        """
+        Acquire tmp lock, call func(lock) and release the lock whatever the result is
+        :return: Deferred firing with func's result or failing with EzekielLockLost if the lock
+            was lost while func was running
+        """
+        def _cb_lock(lock):
+            lost = []
+            self._watch(lock, lambda lock, reason: lost.append(reason))
+            return maybeDeferred(func, lock).addBoth(_release, lock, lost)
+
+        def _release(result, lock, lost):
+            if lost:
+                return failure.Failure(EzekielLockLost(lock, lost[0]))
+            return self.release(lock).addBoth(lambda _: result)
+
+        return self.acquire_tmp(object_id, timeout).addCallback(_cb_lock)
+
+    def close(self):
+        if self._prolong_lc.running:
+            self._prolong_lc.stop()
+        with self._held_lock:
+            self._held.clear()
+            self._watchers.clear()
+        for protocol in list(self._connections):
+            if protocol.transport is not None:
+                protocol.transport.loseConnection()
+        del self._connections[:]
+
+
+class _BlockingConnection(object):
+    def __init__(self, address, token, timeout):
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address, timeout)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+        self.reader = None
+        try:
+            if not isinstance(address, tuple):
+                self.sock.connect(address)
+            self.reader = self.sock.makefile('rb')
+            self.user_id = parse_response(self.call(['AUTH %s' % token.encode('hex')])[0])[0]
+        except Exception:
+            self.close()
+            raise
+
+    def call(self, lines):
+        """
+        Send all the lines at once and read as many responses
+        :param lines: request lines
+        :return: list of raw response lines
+        """
+        self.sock.sendall(''.join(line + '\n' for line in lines))
+        result = []
+        for _ in lines:
+            line = self.reader.readline()
+            if not line:
+                raise EzekielClientError('Connection closed')
+            result.append(line.rstrip('\r\n'))
+        return result
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.sock.close()
+
+
+class EzekielBlockingClient(_ClientBase):
+    """
+    Thread-safe blocking client
+    :param address: (host, port) tuple or Unix socket path
+    :param token: Castiel authentication token (raw bytes)
+    :param pool_size: Maximum number of persistent connections, i.e. concurrent requests
+    :param prolong_margin: Prolong tmp locks that expire within this many seconds
+    :param on_lock_lost: Called as on_lock_lost(lock, reason) for every tmp lock the server has dropped.
+        Note it is called from the prolonging thread.
+    """
+    def __init__(self, address, token, pool_size=2, prolong_margin=10, timeout=10, on_lock_lost=None):
+        super(EzekielBlockingClient, self).__init__(token, prolong_margin, on_lock_lost)
+        self.address = address
+        self.timeout = timeout
+        self._idle = []
+        self._all = []
+        self._pool_lock = threading.Condition()
+        self._pool_semaphore = threading.BoundedSemaphore(pool_size)
+        self._closed = threading.Event()
+        self._prolonger = None
+
+    def _checkout(self, fresh=False):
+        """
+        :return: (connection, True if it has just been established)
+        """
+        self._pool_semaphore.acquire()
+        with self._pool_lock:
+            if self._idle and not fresh:
+                return self._idle.pop(), False
+        try:
+            connection = _BlockingConnection(self.address, self.token, self.timeout)
+        except Exception:
+            self._pool_semaphore.release()
+            raise
+        with self._pool_lock:
+            self._all.append(connection)
+        self.user_id = connection.user_id
+        return connection, True
+
+    def _checkin(self, connection, broken=None):
+        """
+        :param broken: reason the connection is unusable, if it is
+        """
+        with self._pool_lock:
+            if broken is None:
+                self._idle.append(connection)
+            elif connection in self._all:
+                self._all.remove(connection)
+            self._pool_lock.notify_all()
+        self._pool_semaphore.release()
+        if broken is not None:
+            connection.close()
+            self._lose_connection(connection, broken)
+
+    def _request(self, lines):
+        """
+        :return: (connection used, list of raw response lines)
+        """
+        connection, fresh = self._checkout()
+        try:
+            result = connection.call(lines)
+        except (socket.error, EzekielClientError) as exc:
+            self._checkin(connection, exc)
+            if fresh:
+                raise
+            # Idle connection might have been closed by the server meanwhile, try once more
+            connection, fresh = self._checkout(True)
+            try:
+                result = connection.call(lines)
+            except (socket.error, EzekielClientError) as exc:
+                self._checkin(connection, exc)
+                raise
+        self._checkin(connection)
+        return connection, result
+
+    def _request_on(self, connection, lines):
+        """
+        Send the lines over the given pooled connection, waiting for it to become idle
+        :return: list of raw response lines
+        :raise: EzekielClientError if the connection is closed
+        """
+        self._pool_semaphore.acquire()
+        with self._pool_lock:
+            while connection in self._all and connection not in self._idle:
+                self._pool_lock.wait()
+            if connection not in self._all:
+                self._pool_semaphore.release()
+                raise EzekielClientError('Connection closed')
+            self._idle.remove(connection)
+        try:
+            result = connection.call(lines)
+        except (socket.error, EzekielClientError) as exc:
+            self._checkin(connection, exc)
+            raise
+        self._checkin(connection)
+        return result
+
+    def _call(self, lines):
+        return self._request(lines)[1]
+
+    def _hold(self, lock, connection=None):
+        super(EzekielBlockingClient, self)._hold(lock, connection)
+        if lock.lease is None:
+            return lock
+        with self._pool_lock:
+            if self._prolonger is None:
+                self._prolonger = threading.Thread(target=self._prolong_loop, name='ezekiel-prolonger')
+                self._prolonger.daemon = True
+                self._prolonger.start()
+        return lock
+
+    def _prolong_loop(self):
+        while not self._closed.wait(self.prolong_period):
+            by_connection = {}
+            for lock in self._due():
+                by_connection.setdefault(self._connection_of(lock), []).append(lock)
+            for connection, locks in by_connection.items():
+                if connection is None:
+                    continue
+                try:
+                    responses = self._request_on(connection, [
+                        'PROLONG %s %s' % (lock.object_id, lock.token.encode('hex'))
+                        for lock in locks
+                    ])
+                except (socket.error, EzekielClientError) as exc:
+                    # Locks of the broken connection are already reported lost by _checkin
+                    log.msg(u'Could not prolong locks: %s' % exc, system='Ezekiel:Client')
+                    continue
+                for lock, response in zip(locks, responses):
+                    try:
+                        self._hold(self._make_lock(parse_response(response)))
+                    except (LockAlreadyAcquired, LockNotFound, EzekielClientError) as exc:
+                        self._lose([lock], exc)
+
+    def ping(self):
+        return parse_response(self._call(['PING'])[0])
+
+    def acquire(self, object_id):
+        return self._make_lock(parse_response(self._call(['ACQUIRE %s' % object_id])[0]))
+
+    def acquire_tmp(self, object_id, timeout=None):
+        line = 'ACQUIRE_TMP %s' % object_id if timeout is None else 'ACQUIRE_TMP %s %s' % (object_id, timeout)
+        connection, responses = self._request([line])
+        return self._hold(self._make_lock(parse_response(responses[0])), connection)
+
+    def acquire_tmp_many(self, object_ids, timeout=None):
+        """
+        Acquire tmp locks for several objects in one pipelined round trip
+        :param object_ids: list of object identifiers
+        :return: list of Lock or exception instances in the order of object_ids
+        """
+        result = []
+        suffix = '' if timeout is None else ' %s' % timeout
+        connection, responses = self._request(['ACQUIRE_TMP %s%s' % (object_id, suffix) for object_id in object_ids])
+        for response in responses:
+            try:
+                result.append(self._hold(self._make_lock(parse_response(response)), connection))
+            except (LockAlreadyAcquired, LockNotFound, EzekielClientError) as exc:
+                result.append(exc)
+        return result
+
+    def _call_for(self, lock, line, connection=None):
+        """
+        Send the line over the connection lock was acquired on, if it is a held tmp lock
+        """
+        connection = connection or self._connection_of(lock)
+        if connection is None:
+            return self._call([line])[0]
+        try:
+            return self._request_on(connection, [line])[0]
+        except (socket.error, EzekielClientError):
+            # The server has released the lock together with its connection
+            raise LockNotFound(lock.object_id)
+
+    def prolong(self, lock):
+        line = 'PROLONG %s %s' % (lock.object_id, lock.token.encode('hex'))
+        return self._hold(self._make_lock(parse_response(self._call_for(lock, line))))
+
+    def release(self, lock):
+        line = 'RELEASE %s %s' % (lock.object_id, lock.token.encode('hex'))
+        connection = self._connection_of(lock)
+        self._forget(lock.object_id)
+        return parse_response(self._call_for(lock, line, connection))
+
+    @contextlib.contextmanager
+    def locked(self, object_id, timeout=None):
+        """
+        Hold tmp lock for the duration of the with-block. Use is_held(lock) to check
+        the lock is still there; EzekielLockLost is raised on exit if it was lost.
+        """
+        lock = self.acquire_tmp(object_id, timeout)
+        lost = []
+        self._watch(lock, lambda lock, reason: lost.append(reason))
+        try:
+            yield lock
+        finally:
+            if not lost:
+                try:
+                    self.release(lock)
+                except LockNotFound:
+                    pass
+        if lost:
+            raise EzekielLockLost(lock, lost[0])
+
+    def close(self):
+        self._closed.set()
+        with self._held_lock:
+            self._held.clear()
+            self._watchers.clear()
+        with self._pool_lock:
+            connections, self._all, self._idle = self._all, [], []
+            self._pool_lock.notify_all()
+        for connection in connections:
+            connection.close()
@@ -25,21 +25,44 @@ class ILockService(Interface):
         :raise: LockNotFound
         """
 
+    def release_locks(self, locks):
+        """
+        Release several locks at once
+        :param locks: iterable of Lock
+        :return: list of LockReleased for the locks that were actually released
+        """
+
+    def get_locks_info(self, object_ids):
+        """
+        Get information about the locked objects without affecting locks
+        :param object_ids: list of Object identifiers
+        :return: list of LockInfo for the locked objects only
+        """
+
+    def get_locks_info_by_prefix(self, prefixes):
+        """
+        Get information about the locked objects whose identifiers start with any of prefixes
+        :param prefixes: list of Object identifier prefixes
+        :return: list of LockInfo
+        """
+
 
 class ITmpLockService(Interface):
-    def acquire_tmp_lock(self, object_id, locker):
+    def acquire_tmp_lock(self, object_id, locker, timeout=None):
         """
         Acquire Lock until timeout
         :param object_id: Object identifier
         :param locker: Locker identifier
+        :param timeout: Requested lease in seconds, clamped to the object's lease policy
         :return: lock id (token)
         """
 
-    def prolong_tmp_lock(self, object_id, token):
+    def prolong_tmp_lock(self, object_id, token, timeout=None):
         """
         Prolong locking
         :param object_id: Object identifier
         :param token: Lock identifier
+        :param timeout: Requested lease in seconds, clamped to the object's lease policy
         :return:
         :raise: LockNotFound
         """
@@ -87,15 +110,18 @@ class ILockSession(Interface):
 
 
 class IRestService(Interface):
-    def acquire_tmp_lock(self, object_id, locker):
+    def acquire_tmp_lock(self, object_id, locker, timeout=None):
         pass
 
-    def prolong_tmp_lock(self, object_id, token):
+    def prolong_tmp_lock(self, object_id, token, timeout=None):
         pass
 
     def release_lock(self, object_id, token):
         pass
 
+    def get_locks_info(self, object_ids):
+        pass
+
 
 class IWsLockFactory(Interface):
     def register(self, client):
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Line-based lock protocol for trusted service-to-service clients.
+
+Every request is a single line, every response is a single line, and responses
+are written in the same order the requests were received, so clients may pipeline
+as many requests as they like without waiting for replies::
+
+    AUTH <castiel token hex>              -> OK <user_id>
+    ACQUIRE <object_id>                   -> OK <object_id> <token> <acquire> - -
+    ACQUIRE_TMP <object_id> [lease]       -> OK <object_id> <token> <acquire> <expiration> <lease>
+    PROLONG <object_id> <token> [lease]   -> OK <object_id> <token> <acquire> <expiration> <lease>
+    RELEASE <object_id> <token>           -> OK <object_id>
+    PING                                  -> PONG
+
+Failures are reported as ``LOCKED <object_id> <acquire> <locker>``,
+``NOTFOUND <object_id>`` or ``ERR <message>``. All the locks acquired over a
+connection are released when the connection is lost.
+"""
+from collections import deque
+
+from twisted.application.service import Service
+from twisted.internet.endpoints import serverFromString
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from bouser.helpers.plugin_helpers import BouserPlugin, Dependency
+from .service import LockAlreadyAcquired, LockNotFound
+
+__author__ = 'viruzzz-kun'
+
+
+class EzekielLineProtocol(LineReceiver):
+    """
+    @type factory: EzekielLineFactory
+    """
+    delimiter = '\n'
+    MAX_LENGTH = 4096
+
+    def __init__(self):
+        self.user_id = None
+        self.locks = {}
+        self._pending = deque()
+        self._blocked = False
+
+    def _log(self, msg, *args):
+        if args:
+            msg = msg % args
+        return log.msg(msg, system=u'Ezekiel:Socket[%s], uid=%s' % (self.transport.getPeer(), self.user_id))
+
+    def connectionLost(self, reason):
+        self._release_all()
+        self._pending.clear()
+
+    def lineReceived(self, line):
+        if self._blocked:
+            self._pending.append(line)
+        else:
+            self._dispatch(line)
+
+    def lineLengthExceeded(self, line):
+        self.sendLine('ERR Line too long')
+        self.transport.loseConnection()
+
+    def _drain(self):
+        while self._pending and not self._blocked:
+            self._dispatch(self._pending.popleft())
+
+    def _dispatch(self, line):
+        parts = line.strip().split()
+        if not parts:
+            return
+        command, args = parts[0].lower(), parts[1:]
+        if command == 'auth':
+            self._authenticate(args)
+            return
+        if command == 'ping':
+            self.sendLine('PONG')
+            return
+        if self.user_id is None:
+            self.sendLine('ERR Unauthorized')
+            return
+        method = getattr(self, 'command_%s' % command, None)
+        if method is None:
+            self.sendLine('ERR Unknown command %s' % command)
+            return
+        try:
+            self.sendLine(method(*args))
+        except (TypeError, ValueError):
+            self.sendLine('ERR Wrong arguments for %s' % command)
+        except LockAlreadyAcquired as exc:
+            self.sendLine('LOCKED %s %s %s' % (exc.object_id, exc.acquire_time, exc.locker))
+        except LockNotFound as exc:
+            self.sendLine('NOTFOUND %s' % exc.object_id)
+
+    def _authenticate(self, args):
+        def _cb(user_id):
+            if not user_id:
+                raise ValueError(user_id)
+            self.user_id = user_id
+            self.sendLine('OK %s' % user_id)
+            self._log('Authenticated')
+
+        def _eb(failure):
+            self.sendLine('ERR Unauthorized')
+            self._log(u'Authentication failed %s', failure.getErrorMessage())
+            self.transport.loseConnection()
+
+        def _unblock(result):
+            self._blocked = False
+            self._drain()
+
+        try:
+            token = args[0].decode('hex')
+        except (IndexError, TypeError):
+            self.sendLine('ERR Unauthorized')
+            return
+        self._blocked = True
+        self.factory.cas.get_user_id(token).addCallback(_cb).addErrback(_eb).addBoth(_unblock)
+
+    @staticmethod
+    def _format_lock(lock):
+        return 'OK %s %s %s %s %s' % (
+            lock.object_id,
+            lock.token.encode('hex'),
+            lock.acquire_time,
+            '-' if lock.expiration_time is None else int(lock.expiration_time),
+            '-' if lock.lease is None else lock.lease,
+        )
+
+    def command_acquire(self, object_id):
+        lock = self.factory.ezekiel.acquire_lock(object_id, self.user_id)
+        self.locks[object_id] = lock
+        return self._format_lock(lock)
+
+    def command_acquire_tmp(self, object_id, timeout=None):
+        if timeout is not None:
+            timeout = int(timeout)
+        own_lock = self.locks.pop(object_id, None)
+        if own_lock is not None:
+            # Re-acquiring a lock held by this very connection prolongs it
+            try:
+                lock = self.factory.ezekiel.prolong_tmp_lock(object_id, own_lock.token, timeout)
+            except LockNotFound:
+                pass
+            else:
+                self.locks[object_id] = lock
+                return self._format_lock(lock)
+        # The service would hand the lock of the same locker over, but other connections
+        # of the same service account must not share it
+        held = self.factory.ezekiel.get_locks_info([object_id])
+        if held:
+            raise LockAlreadyAcquired(held[0])
+        lock = self.factory.ezekiel.acquire_tmp_lock(object_id, self.user_id, timeout)
+        self.locks[object_id] = lock
+        return self._format_lock(lock)
+
+    def command_prolong(self, object_id, token, timeout=None):
+        if timeout is not None:
+            timeout = int(timeout)
+        lock = self.factory.ezekiel.prolong_tmp_lock(object_id, token.decode('hex'), timeout)
+        return self._format_lock(lock)
+
+    def command_release(self, object_id, token):
+        result = self.factory.ezekiel.release_lock(object_id, token.decode('hex'))
+        self.locks.pop(object_id, None)
+        return 'OK %s' % result.object_id
+
+    def _release_all(self):
+        locks = self.locks.keys()
+        if not locks:
+            return
+        self.factory.ezekiel.release_locks(self.locks.values())
+        self.locks.clear()
+        self._log(u'Released locks: %s', ', '.join(locks))
+
+
+class EzekielLineFactory(ServerFactory):
+    protocol = EzekielLineProtocol
+
+    def __init__(self, ezekiel, cas):
+        self.ezekiel = ezekiel
+        self.cas = cas
+
+
+class EzekielSocketService(Service, BouserPlugin):
+    """
+    @type ezekiel: bouser_ezekiel.service.EzekielService
+    @type cas: bouser.castiel.service.CastielService
+    """
+    signal_name = 'bouser.ezekiel.socket'
+    ezekiel = Dependency('bouser.ezekiel')
+    cas = Dependency('bouser.castiel')
+
+    def __init__(self, config):
+        self.endpoint = config.get('endpoint', 'tcp:5051:interface=127.0.0.1')
+        self.port = None
+
+    def startService(self):
+        from twisted.internet import reactor
+
+        def _cb(port):
+            self.port = port
+            log.msg('Listening on %s' % self.endpoint, system="Ezekiel:Socket")
+
+        Service.startService(self)
+        factory = EzekielLineFactory(self.ezekiel, self.cas)
+        return serverFromString(reactor, self.endpoint).listen(factory).addCallback(_cb)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self.port is not None:
+            port, self.port = self.port, None
+            return port.stopListening()
+
+
+def make(config):
+    return EzekielSocketService(config)
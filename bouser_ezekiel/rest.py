@@ -1,22 +1,41 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
+import json
+
 from twisted.internet import defer
+from twisted.web import http
 from twisted.web.resource import IResource, Resource
 from zope.interface import implementer
 
-from bouser.excs import Unauthorized, UnknownCommand
+from bouser.excs import SerializableBaseException, Unauthorized, UnknownCommand
 from bouser.helpers.plugin_helpers import BouserPlugin, Dependency
-from bouser.utils import api_method
+from bouser.utils import api_method, safe_int
 from .interfaces import IRestService
 
 __author__ = 'viruzzz-kun'
 __created__ = '05.10.2014'
 
 
+class InvalidStatusQuery(SerializableBaseException):
+    __slots__ = ['message']
+
+    def __init__(self, message):
+        self.message = message
+
+    def __json__(self):
+        return {
+            'success': False,
+            'exception': self.__class__.__name__,
+            'message': self.message,
+        }
+
+
 @implementer(IResource, IRestService)
 class EzekielRestResource(Resource, BouserPlugin):
     signal_name = 'bouser.ezekiel.rest'
     isLeaf = True
+    max_status_ids = 1000
 
     service = Dependency('bouser.ezekiel')
     cas = Dependency('bouser.castiel')
@@ -35,18 +54,41 @@ class EzekielRestResource(Resource, BouserPlugin):
 
         request.setHeader('Content-Type', 'application/json; charset=utf-8')
         pp = filter(None, request.postpath)
-        if len(pp) == 2:
+        if pp == ['status']:
+            if request.method != 'POST':
+                request.setResponseCode(http.NOT_ALLOWED)
+                request.setHeader('Allow', 'POST')
+                defer.returnValue('')
+            locker_id = yield self.cas.request_get_user_id(request)
+            if not locker_id:
+                request.setResponseCode(403)
+                raise Unauthorized()
+            try:
+                object_ids = self._get_object_ids(request)
+            except InvalidStatusQuery:
+                request.setResponseCode(http.BAD_REQUEST)
+                raise
+            result = yield self.get_locks_info(object_ids)
+            etag = self._make_etag(result)
+            request.setHeader('ETag', etag)
+            if_none_match = request.getHeader('If-None-Match') or ''
+            if etag in [tag.strip() for tag in if_none_match.split(',')]:
+                # twisted.web drops the body of 304 responses itself
+                request.setResponseCode(http.NOT_MODIFIED)
+                defer.returnValue('')
+            defer.returnValue(result)
+        elif len(pp) == 2:
             command, object_id = pp
             if command == 'acquire':
                 locker_id = yield self.cas.request_get_user_id(request)
                 if not locker_id:
                     request.setResponseCode(403)
                     raise Unauthorized()
-                result = yield self.acquire_tmp_lock(object_id, locker_id)
+                result = yield self.acquire_tmp_lock(object_id, locker_id, self._get_timeout(request))
                 defer.returnValue(result)
             elif command == 'prolong':
                 token = request.args.get('token', [''])[0]
-                result = yield self.prolong_tmp_lock(object_id, token.decode('hex'))
+                result = yield self.prolong_tmp_lock(object_id, token.decode('hex'), self._get_timeout(request))
                 defer.returnValue(result)
             elif command == 'release':
                 token = request.args.get('token', [''])[0]
@@ -57,15 +99,45 @@ class EzekielRestResource(Resource, BouserPlugin):
         else:
             request.setResponseCode(404)
 
-    def acquire_tmp_lock(self, object_id, locker):
-        return self.service.acquire_tmp_lock(object_id, locker)
+    @staticmethod
+    def _get_timeout(request):
+        timeout = request.args.get('timeout', [''])[0]
+        return safe_int(timeout) if timeout else None
 
-    def prolong_tmp_lock(self, object_id, token):
-        return self.service.prolong_tmp_lock(object_id, token)
+    @staticmethod
+    def _make_etag(locks_info):
+        state = sorted([info.object_id, info.acquire_time, info.locker] for info in locks_info)
+        return '"%s"' % hashlib.sha1(json.dumps(state)).hexdigest()[:16]
+
+    def _get_object_ids(self, request):
+        object_ids = list(request.args.get('object_id', []))
+        if (request.getHeader('Content-Type') or '').startswith('application/json'):
+            request.content.seek(0)
+            try:
+                document = json.loads(request.content.read() or '[]')
+            except ValueError:
+                raise InvalidStatusQuery(u'Malformed JSON')
+            if isinstance(document, dict):
+                document = document.get('object_ids') or []
+            if not isinstance(document, list) or not all(isinstance(item, basestring) for item in document):
+                raise InvalidStatusQuery(u'Expected a list of object_id strings')
+            object_ids.extend(document)
+        if len(object_ids) > self.max_status_ids:
+            raise InvalidStatusQuery(u'Too many object_ids, at most %s allowed' % self.max_status_ids)
+        return object_ids
+
+    def acquire_tmp_lock(self, object_id, locker, timeout=None):
+        return self.service.acquire_tmp_lock(object_id, locker, timeout)
+
+    def prolong_tmp_lock(self, object_id, token, timeout=None):
+        return self.service.prolong_tmp_lock(object_id, token, timeout)
 
     def release_lock(self, object_id, token):
         return self.service.release_lock(object_id, token)
 
+    def get_locks_info(self, object_ids):
+        return self.service.get_locks_info(object_ids)
+
 
 def make(config):
     return EzekielRestResource()
@@ -19,17 +19,21 @@ __created__ = '13.09.2014'
 
 ezekiel_lock_acquired = blinker.signal('bouser.ezekiel:lock.acquired')
 ezekiel_lock_released = blinker.signal('bouser.ezekiel:lock.released')
+ezekiel_locks_released = blinker.signal('bouser.ezekiel:locks.released')
 
 
 class Lock(object):
-    __slots__ = ['object_id', 'acquire_time', 'expiration_time', 'token', 'locker']
+    __slots__ = ['object_id', 'acquire_time', 'expiration_time', 'token', 'locker', 'lease', 'renewed', 'steady']
 
-    def __init__(self, object_id, acquire_time, expiration_time, token, locker):
+    def __init__(self, object_id, acquire_time, expiration_time, token, locker, lease=None):
         self.object_id = object_id
         self.acquire_time = int(acquire_time)
         self.expiration_time = int(expiration_time) if isinstance(expiration_time, float) else expiration_time
         self.token = token
         self.locker = locker
+        self.lease = lease
+        self.renewed = self.acquire_time
+        self.steady = 0
 
     def __json__(self):
         return {
@@ -39,9 +43,50 @@ class Lock(object):
             'expiration': self.expiration_time,
             'token': self.token.encode('hex'),
             'locker': self.locker,
+            'lease': self.lease,
         }
 
 
+class LeasePolicy(object):
+    """
+    Lease lengths granted to tmp locks of some objects
+    """
+    __slots__ = ['timeout', 'min_timeout', 'max_timeout', 'adaptive']
+    adaptive_after = 3
+    adaptive_growth = 1.25
+
+    def __init__(self, timeout, min_timeout, max_timeout, adaptive=False):
+        if not min_timeout <= timeout <= max_timeout:
+            raise ValueError(
+                'Lease policy must satisfy min_timeout <= timeout <= max_timeout, got %s <= %s <= %s' %
+                (min_timeout, timeout, max_timeout))
+        self.timeout = timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.adaptive = adaptive
+
+    def grant(self, requested=None):
+        """
+        Lease for a newly acquired lock
+        :param requested: lease requested by the locker, clamped to policy limits
+        """
+        if requested is None:
+            return self.timeout
+        return max(self.min_timeout, min(self.max_timeout, int(requested)))
+
+    def extend(self, lock, requested=None):
+        """
+        Lease for a prolonged lock. In adaptive mode holders with a steady prolong
+        history (see EzekielService.prolong_tmp_lock) get their lease grown by a quarter
+        on every further steady prolong up to max_timeout.
+        """
+        if requested is not None:
+            return self.grant(requested)
+        if self.adaptive and lock.steady >= self.adaptive_after:
+            return min(self.max_timeout, int(lock.lease * self.adaptive_growth))
+        return lock.lease
+
+
 class LockAlreadyAcquired(SerializableBaseException):
     __slots__ = ['object_id', 'acquire_time', 'locker', 'message']
 
@@ -117,21 +162,51 @@ class EzekielService(Service, BouserPlugin):
     def __init__(self, config):
         self.short_timeout = config.get('short_timeout', 60)
         self.long_timeout = config.get('long_timeout', 3600)
+        self.default_lease_policy = LeasePolicy(
+            self.short_timeout,
+            int(config.get('min_timeout', min(10, self.short_timeout))),
+            int(config.get('max_timeout', self.short_timeout)),
+            bool(config.get('adaptive_lease', False)),
+        )
+        self.lease_policies = sorted(
+            ((prefix, self.__make_policy(policy, self.default_lease_policy))
+             for prefix, policy in config.get('lease_policies', {}).items()),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
         self.__locks = {}
 
-    def __acquire_lock(self, object_id, locker, short):
+    @staticmethod
+    def __make_policy(config, defaults):
+        if not isinstance(config, dict):
+            config = {'timeout': config}
+        timeout = int(config.get('timeout', defaults.timeout))
+        return LeasePolicy(
+            timeout,
+            int(config.get('min_timeout', min(timeout, defaults.min_timeout))),
+            int(config.get('max_timeout', max(timeout, defaults.max_timeout))),
+            bool(config.get('adaptive', defaults.adaptive)),
+        )
+
+    def get_lease_policy(self, object_id):
+        for prefix, policy in self.lease_policies:
+            if object_id.startswith(prefix):
+                return policy
+        return self.default_lease_policy
+
+    def __acquire_lock(self, object_id, locker, short, requested_timeout=None):
         logging.info('Acquiring lock %s', object_id)
         acquired_lock = self.__locks.get(object_id)
         if acquired_lock is not None:
             if short and acquired_lock[0].locker == locker:
-                return self.prolong_tmp_lock(object_id, acquired_lock[0].token)
+                return self.__prolong_lock(object_id, acquired_lock[0].token, requested_timeout, False)
             raise LockAlreadyAcquired(self.__locks[object_id][0])
         t = time.time()
         token = uuid.uuid4().bytes
         if short:
             from twisted.internet import reactor
-            timeout = self.short_timeout if short else None
-            lock = Lock(object_id, t, t + timeout, token, locker)
+            timeout = self.get_lease_policy(object_id).grant(requested_timeout)
+            lock = Lock(object_id, t, t + timeout, token, locker, timeout)
             delayed_call = reactor.callLater(timeout, self.release_lock, object_id, token)
         else:
             lock = Lock(object_id, t, None, token, locker)
@@ -145,8 +220,25 @@ class EzekielService(Service, BouserPlugin):
     def acquire_lock(self, object_id, locker):
         return self.__acquire_lock(object_id, locker, False)
 
-    def acquire_tmp_lock(self, object_id, locker):
-        return self.__acquire_lock(object_id, locker, True)
+    def acquire_tmp_lock(self, object_id, locker, timeout=None):
+        return self.__acquire_lock(object_id, locker, True, timeout)
+
+    def get_locks_info(self, object_ids):
+        return [
+            LockInfo(self.__locks[object_id][0])
+            for object_id in object_ids
+            if object_id in self.__locks
+        ]
+
+    def get_locks_info_by_prefix(self, prefixes):
+        prefixes = tuple(prefixes)
+        if not prefixes:
+            return []
+        return [
+            LockInfo(lock)
+            for object_id, (lock, delayed_call) in self.__locks.items()
+            if object_id.startswith(prefixes)
+        ]
 
     def release_lock(self, object_id, token):
         if object_id in self.__locks:
@@ -167,17 +259,70 @@ class EzekielService(Service, BouserPlugin):
                 log.msg('lock for %s released' % object_id, system="Ezekiel")
                 logging.info('lock for %s released', object_id)
                 ezekiel_lock_released.send(lock)
+                ezekiel_locks_released.send([lock])
                 return LockReleased(lock)
             raise LockNotFound(object_id)
         raise LockNotFound(object_id)
 
-    def prolong_tmp_lock(self, object_id, token):
+    def release_locks(self, locks):
+        """
+        Release several locks at once skipping those already expired or released.
+        Every lock is announced the same way release_lock does it ('ezekiel.lock.release'
+        message and ezekiel_lock_released signal), then a single ezekiel_locks_released
+        signal with the list of released locks is sent for the whole batch.
+        :param locks: iterable of Lock
+        :return: list of LockReleased
+        """
+        released = []
+        for lock in locks:
+            acquired_lock = self.__locks.get(lock.object_id)
+            if acquired_lock is None or acquired_lock[0].token != lock.token:
+                continue
+            del self.__locks[lock.object_id]
+            delayed_call = acquired_lock[1]
+            if delayed_call and delayed_call.active():
+                delayed_call.cancel()
+            released.append(acquired_lock[0])
+        if not released:
+            return []
+        object_ids = [lock.object_id for lock in released]
+
+        if self.simargl:
+            for object_id in object_ids:
+                message = self.simargl.Message()
+                message.topic = 'ezekiel.lock.release'
+                message.data = {
+                    'object_id': object_id
+                }
+                self.simargl.inject_message(message)
+
+        log.msg('locks for %s released' % ', '.join(object_ids), system="Ezekiel")
+        logging.info('locks for %s released', ', '.join(object_ids))
+        for lock in released:
+            ezekiel_lock_released.send(lock)
+        ezekiel_locks_released.send(released)
+        return [LockReleased(lock) for lock in released]
+
+    def prolong_tmp_lock(self, object_id, token, timeout=None):
+        return self.__prolong_lock(object_id, token, timeout, True)
+
+    def __prolong_lock(self, object_id, token, timeout, track_cadence):
         if object_id in self.__locks:
-            lock, timeout = self.__locks[object_id]
+            lock, delayed_call = self.__locks[object_id]
             if lock.token == token:
-                lock.expiration_time = time.time() + self.short_timeout
-                if timeout:
-                    timeout.reset(self.short_timeout)
+                now = time.time()
+                if delayed_call:
+                    if track_cadence:
+                        # Steady holder renews once per lease, in its second half
+                        elapsed = now - lock.renewed
+                        if lock.lease / 2.0 <= elapsed <= lock.lease:
+                            lock.steady += 1
+                        else:
+                            lock.steady = 0
+                    lock.renewed = now
+                    lock.lease = self.get_lease_policy(object_id).extend(lock, timeout)
+                    delayed_call.reset(lock.lease)
+                lock.expiration_time = now + (lock.lease or self.short_timeout)
                 return lock
             raise LockAlreadyAcquired(lock)
         raise LockNotFound(object_id)
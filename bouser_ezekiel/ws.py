@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import datetime
 import json
+import uuid
 
 import blinker
 from autobahn.twisted import WebSocketServerFactory, WebSocketServerProtocol
@@ -9,7 +10,7 @@ from twisted.python import log
 
 from bouser.helpers.plugin_helpers import BouserPlugin, Dependency
 from bouser.utils import as_json
-from bouser_ezekiel.service import LockAlreadyAcquired, LockNotFound
+from bouser_ezekiel.service import LockAlreadyAcquired, LockNotFound, LockInfo
 
 __author__ = 'viruzzz-kun'
 
@@ -21,7 +22,7 @@ client_subscribed = blinker.signal('bouser.ezekiel.ws:subscribed')
 client_unsubscribed = blinker.signal('bouser.ezekiel.ws:unsubscribed')
 
 ezekiel_lock_acquired = blinker.signal('bouser.ezekiel:lock.acquired')
-ezekiel_lock_released = blinker.signal('bouser.ezekiel:lock.released')
+ezekiel_locks_released = blinker.signal('bouser.ezekiel:locks.released')
 
 
 def get_cookies(headers):
@@ -39,10 +40,24 @@ def get_cookies(headers):
 
 class EzekielWebSocketProtocol(WebSocketServerProtocol):
     """
+    Authentication runs after the WebSocket handshake, so clients should wait for
+    the 'session' event before issuing commands. Subscriptions sent earlier are
+    queued until then; the number of queued ones is limited by max_pending_subscriptions.
+
+    Locks are released as soon as the client closes the connection normally (code 1000).
+    If the connection drops otherwise, the session is kept for factory.resume_grace seconds
+    and can be taken over by a new connection presenting the resume token from the 'session'
+    event, either in the X-Ezekiel-Resume handshake header or as the first message
+    ``{"command": "resume", "token": ...}``. The token is never accepted in the URL, which
+    ends up in access logs. A connection whose session is taken over receives the
+    'session_taken' event and is closed with code 4001.
+
     @type factory: EzekielWebSocketFactory
     """
     factory = None
     ping_period = 30
+    max_pending_subscriptions = 32
+    resume_header = u'x-ezekiel-resume'
 
     def __init__(self):
         super(EzekielWebSocketProtocol, self).__init__()
@@ -50,15 +65,25 @@ class EzekielWebSocketProtocol(WebSocketServerProtocol):
         self.cookies = {}
         self.locks = {}
         self.waiting_locks = set()
+        self.subscriptions = set()
+        self.prefix_subscriptions = set()
+        self.changes = {}
+        self.pending_subscriptions = []
         self.user_id = None
+        self.resume_token = None
+        self.resumed = False
+        self.detached = False
         self.actually_connected = False
+        self.opened = False
 
     def _pinger_func(self):
         self.sendEvent('ping', datetime.datetime.utcnow())
 
     def _authenticate(self, cookies):
         def _cb_set_user_id(user_id):
-            self.user_id = user_id
+            # The session might have been resumed while CAS was thinking
+            if not self.resumed:
+                self.user_id = user_id
             return user_id
 
         cas = self.factory.cas
@@ -96,55 +121,165 @@ class EzekielWebSocketProtocol(WebSocketServerProtocol):
         """
 
         def _cb(result):
-            self._pinger_lc.start(30, False)
-            self.actually_connected = True
-            client_connected.send(self)
-            ezekiel_lock_released.connect(self._retry_acquire_after_release)
+            if self.resumed:
+                return result
+            self._start_session()
             self._log('Authenticated')
             return result
 
         def _eb(failure):
+            if self.resumed:
+                return
             self.sendClose()
             self._log_na(u'Authentication failed %s', failure)
             return failure
 
         super(EzekielWebSocketProtocol, self).onConnect(request)
         self._log_na('Connection request')
+        resume_token = request.headers.get(self.resume_header)
+        if resume_token and self._resume(resume_token):
+            return
         cookies = self.cookies = get_cookies(request.headers)
         self._authenticate(cookies).addCallbacks(_cb, _eb)
 
+    def onOpen(self):
+        self.opened = True
+        if self.actually_connected:
+            self._session_ready()
+
+    def _resume(self, resume_token):
+        """
+        Take over the session identified by resume_token. Resume token is the credential
+        here, no need to ask CAS again
+        :return: True if the session was resumed
+        """
+        def _refuse(exception, message):
+            # A header presented during the handshake falls back to CAS silently
+            if self.opened:
+                self.sendEvent('exception', {
+                    'success': False,
+                    'exception': exception,
+                    'message': message,
+                })
+            self._log_na(u'Session was not resumed: %s', exception)
+            return False
+
+        if self.resumed or self.locks or self.waiting_locks or resume_token == self.resume_token:
+            return _refuse('ResumeRefused', u'Session can only be resumed by a fresh connection')
+        session = self.factory.resume_session(resume_token)
+        if session is None:
+            return _refuse('SessionNotFound', u'Session has expired or has never existed')
+        self.user_id, self.locks, self.waiting_locks = session
+        self.resumed = True
+        if self.actually_connected:
+            # Already authenticated via CAS: the resumed session gets a fresh token
+            self.factory.live_sessions.pop(self.resume_token, None)
+            self.resume_token = uuid.uuid4().hex
+            self.factory.live_sessions[self.resume_token] = self
+            if self.opened:
+                self._session_ready()
+        else:
+            self._start_session()
+        self._log(u'Resumed session with locks: %s', ', '.join(self.locks.keys()))
+        return True
+
+    def _start_session(self):
+        self._pinger_lc.start(30, False)
+        self.actually_connected = True
+        self.resume_token = uuid.uuid4().hex
+        self.factory.live_sessions[self.resume_token] = self
+        client_connected.send(self)
+        ezekiel_locks_released.connect(self._retry_acquire_after_release)
+        if self.opened:
+            self._session_ready()
+
+    def _session_ready(self):
+        self.sendEvent('session', {
+            'resume_token': self.resume_token,
+            'resumed': self.resumed,
+            'locks': self.locks.values(),
+        })
+        if self.resumed:
+            for object_id in list(self.waiting_locks):
+                self._acquire(object_id)
+        pending, self.pending_subscriptions = self.pending_subscriptions, []
+        for command, object_ids, prefixes in pending:
+            if command == 'subscribe':
+                self._subscribe(object_ids, prefixes)
+            else:
+                self._unsubscribe(object_ids, prefixes)
+
+    def detach_session(self):
+        """
+        Hand the session over to a resuming connection and close this one. A half-open
+        connection won't answer the closing handshake and gets dropped on its timeout
+        :return: (user_id, locks, waiting_locks)
+        """
+        session = self.user_id, self.locks, self.waiting_locks
+        self.locks, self.waiting_locks = {}, set()
+        self.detached = True
+        self.sendEvent('session_taken', {'resume_token': self.resume_token})
+        self.sendClose(4001, u'Session taken over')
+        self._log(u'Session detached')
+        return session
+
     def onClose(self, wasClean, code, reason):
         super(EzekielWebSocketProtocol, self).onClose(wasClean, code, reason)
+        self.factory.unsubscribe_all(self)
         if not self.actually_connected:
             return
         if self._pinger_lc.running:
             self._pinger_lc.stop()
-        ezekiel_lock_released.disconnect(self._retry_acquire_after_release)
-        self._release_all()
+        ezekiel_locks_released.disconnect(self._retry_acquire_after_release)
+        if self.factory.live_sessions.get(self.resume_token) is self:
+            del self.factory.live_sessions[self.resume_token]
+        # Detached session lives on in another connection
+        if not self.detached:
+            # Only abnormal drops are worth resuming, a normal closure means the client is done
+            if self.factory.resume_grace > 0 and not (wasClean and code == self.CLOSE_STATUS_CODE_NORMAL):
+                self.factory.park_session(self.resume_token, self.user_id, self.locks, self.waiting_locks)
+            else:
+                self._release_all()
         client_disconnected.send(self)
         self._log('Disconnected')
 
     def onMessage(self, payload, isBinary):
         document = json.loads(payload)
-        command = document.get('command')  # acquire, release, prolong
+        command = document.get('command')  # resume, acquire, release, prolong, subscribe, unsubscribe
         # magic = document.get('magic')
-        if command == 'acquire':
+        if self.detached:
+            return
+        if command == 'resume':
+            self._resume(document.get('token'))
+        elif command == 'acquire':
             self._acquire(document.get('object_id'))
         elif command == 'release':
             self._release(document.get('object_id'), document.get('token').decode('hex'))
         elif command == 'prolong':
             self._prolong(document.get('object_id'), document.get('token').decode('hex'))
+        elif command in ('subscribe', 'unsubscribe'):
+            object_ids, prefixes = document.get('object_ids') or [], document.get('prefixes') or []
+            if not (self.actually_connected and self.opened):
+                # Locker ids must not leak before authentication is complete
+                if len(self.pending_subscriptions) >= self.max_pending_subscriptions:
+                    self.sendEvent('exception', {
+                        'success': False,
+                        'exception': 'NotAuthenticated',
+                        'message': u'Wait for the "session" event before subscribing',
+                    })
+                else:
+                    self.pending_subscriptions.append((command, object_ids, prefixes))
+            elif command == 'subscribe':
+                self._subscribe(object_ids, prefixes)
+            else:
+                self._unsubscribe(object_ids, prefixes)
 
     def _release_all(self):
         self.waiting_locks.clear()
         locks = self.locks.keys()
         if not locks:
             return
-        for lock in self.locks.values():
-            try:
-                self.factory.ezekiel.release_lock(lock.object_id, lock.token)
-            except (LockNotFound, LockAlreadyAcquired) as exc:
-                self.log.error(u'%s' % exc)
+        self.factory.ezekiel.release_locks(self.locks.values())
         self.locks.clear()
         self._log(u'Released locks: %s', ', '.join(locks))
 
@@ -187,14 +322,44 @@ class EzekielWebSocketProtocol(WebSocketServerProtocol):
             self.sendEvent('prolonged', result)
             self._log(u'"%s" was prolonged', object_id)
 
-    def _retry_acquire_after_release(self, lock_released):
+    def _subscribe(self, object_ids, prefixes):
+        object_ids, prefixes = set(filter(None, object_ids)), set(filter(None, prefixes))
+        self.factory.subscribe(self, object_ids, prefixes)
+        ezekiel = self.factory.ezekiel
+        locks = dict(
+            (info.object_id, info)
+            for info in ezekiel.get_locks_info(object_ids) + ezekiel.get_locks_info_by_prefix(prefixes)
+        )
+        self.sendEvent('subscribed', {
+            'object_ids': list(object_ids),
+            'prefixes': list(prefixes),
+            'locks': locks.values(),
+        })
+        client_subscribed.send(self, object_ids=object_ids, prefixes=prefixes)
+        self._log(u'Subscribed to %s object(s), %s prefix(es)', len(object_ids), len(prefixes))
+
+    def _unsubscribe(self, object_ids, prefixes):
+        object_ids, prefixes = set(object_ids), set(prefixes)
+        self.factory.unsubscribe(self, object_ids, prefixes)
+        self.sendEvent('unsubscribed', {'object_ids': list(object_ids), 'prefixes': list(prefixes)})
+        client_unsubscribed.send(self, object_ids=object_ids, prefixes=prefixes)
+        self._log(u'Unsubscribed from %s object(s), %s prefix(es)', len(object_ids), len(prefixes))
+
+    def send_changes(self):
+        """
+        Send lock state changes coalesced since the last tick
+        """
+        if self.changes:
+            changes, self.changes = self.changes, {}
+            self.sendEvent('changes', changes.values())
+
+    def _retry_acquire_after_release(self, locks_released):
         """
-        @type lock_released: bouser_ezekiel.service.LockReleased
-        @param lock_released:
-        @return:
+        @type locks_released: list of bouser_ezekiel.service.Lock
         """
-        if lock_released.object_id in self.waiting_locks:
-            self._acquire(lock_released.object_id)
+        for lock in locks_released:
+            if lock.object_id in self.waiting_locks:
+                self._acquire(lock.object_id)
 
 
 class EzekielWebSocketFactory(WebSocketServerFactory, BouserPlugin):
@@ -208,6 +373,112 @@ class EzekielWebSocketFactory(WebSocketServerFactory, BouserPlugin):
 
     protocol = EzekielWebSocketProtocol
 
+    def __init__(self, config):
+        WebSocketServerFactory.__init__(self)
+        self.notify_period = float(config.get('notify_period', 0.1))
+        self.resume_grace = float(config.get('resume_grace', 30))
+        self.parked_sessions = {}
+        self.live_sessions = {}
+        self.subscribers = {}
+        self.prefix_subscribers = {}
+        self._dirty = set()
+        self._notify_call = None
+        ezekiel_lock_acquired.connect(self._lock_acquired)
+        # Every release, single or batched, ends up in ezekiel_locks_released
+        ezekiel_locks_released.connect(self._locks_released)
+
+    def park_session(self, resume_token, user_id, locks, waiting_locks):
+        """
+        Keep locks and waiting set of a disconnected client for resume_grace seconds
+        """
+        from twisted.internet import reactor
+        delayed_call = reactor.callLater(self.resume_grace, self._expire_session, resume_token)
+        self.parked_sessions[resume_token] = (user_id, locks, waiting_locks, delayed_call)
+
+    def resume_session(self, resume_token):
+        """
+        Take over a parked session or the session of a connection the server still
+        believes alive
+        :return: (user_id, locks, waiting_locks) or None if there is no such session
+        """
+        live_client = self.live_sessions.pop(resume_token, None)
+        if live_client is not None:
+            return live_client.detach_session()
+        session = self.parked_sessions.pop(resume_token, None)
+        if session is None:
+            return None
+        user_id, locks, waiting_locks, delayed_call = session
+        if delayed_call.active():
+            delayed_call.cancel()
+        return user_id, locks, waiting_locks
+
+    def _expire_session(self, resume_token):
+        user_id, locks, waiting_locks, delayed_call = self.parked_sessions.pop(resume_token)
+        released = self.ezekiel.release_locks(locks.values())
+        log.msg(
+            u'Session of uid=%s expired. Released locks: %s' % (user_id, ', '.join(r.object_id for r in released)),
+            system=u'Ezekiel:WebSocket')
+
+    def subscribe(self, client, object_ids, prefixes):
+        for object_id in object_ids:
+            self.subscribers.setdefault(object_id, set()).add(client)
+        for prefix in prefixes:
+            self.prefix_subscribers.setdefault(prefix, set()).add(client)
+        client.subscriptions.update(object_ids)
+        client.prefix_subscriptions.update(prefixes)
+
+    def unsubscribe(self, client, object_ids, prefixes):
+        for index, keys in ((self.subscribers, object_ids), (self.prefix_subscribers, prefixes)):
+            for key in keys:
+                clients = index.get(key)
+                if clients is not None:
+                    clients.discard(client)
+                    if not clients:
+                        del index[key]
+        client.subscriptions.difference_update(object_ids)
+        client.prefix_subscriptions.difference_update(prefixes)
+
+    def unsubscribe_all(self, client):
+        self.unsubscribe(client, list(client.subscriptions), list(client.prefix_subscriptions))
+        self._dirty.discard(client)
+        client.changes.clear()
+
+    def _interested(self, object_id):
+        result = set(self.subscribers.get(object_id, ()))
+        if self.prefix_subscribers:
+            for i in xrange(1, len(object_id) + 1):
+                result.update(self.prefix_subscribers.get(object_id[:i], ()))
+        return result
+
+    def _notify(self, object_id, change):
+        clients = self._interested(object_id)
+        if not clients:
+            return
+        for client in clients:
+            client.changes[object_id] = change
+        self._dirty.update(clients)
+        if self._notify_call is None:
+            from twisted.internet import reactor
+            self._notify_call = reactor.callLater(self.notify_period, self._send_changes)
+
+    def _send_changes(self):
+        self._notify_call = None
+        dirty, self._dirty = self._dirty, set()
+        for client in dirty:
+            client.send_changes()
+
+    def _lock_acquired(self, lock):
+        change = LockInfo(lock).__json__()
+        change['locked'] = True
+        self._notify(lock.object_id, change)
+
+    def _lock_released(self, lock):
+        self._notify(lock.object_id, {'object_id': lock.object_id, 'locked': False})
+
+    def _locks_released(self, locks):
+        for lock in locks:
+            self._lock_released(lock)
+
     def buildProtocol(self, addr):
         p = self.protocol()
         p.factory = self
@@ -216,4 +487,4 @@ class EzekielWebSocketFactory(WebSocketServerFactory, BouserPlugin):
 
 
 def make(config):
-    return EzekielWebSocketFactory()
+    return EzekielWebSocketFactory(config)